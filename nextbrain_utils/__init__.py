@@ -1 +1,9 @@
-from .combine_hemis import combine_hemis
+def __getattr__(name: str) -> object:
+    # Lazy re-export, so that importing the package (e.g., to run the
+    # command-line interface) does not import numpy and nibabel.
+    if name == "combine_hemis":
+        from .combine_hemis import combine_hemis
+
+        globals()[name] = combine_hemis
+        return combine_hemis
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,5 @@
+"""Run the command-line interface with `python -m nextbrain_utils`."""
+from .cli import main
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+"""Label remapping kernels, compiled with numba when it is available."""
+__author__ = "Yael Balbastre"
+
+# std
+from contextlib import contextmanager
+from typing import Iterator
+
+# externals
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+HAS_NUMBA = numba is not None
+
+# Below this number of voxels, spawning threads costs more than it saves.
+PARALLEL_MIN_SIZE = 1 << 20
+
+
+def remap(
+    inp: np.ndarray,
+    table: np.ndarray,
+    keep_outside: bool = True,
+    out: np.ndarray | None = None,
+) -> np.ndarray:
+    """
+    Map labels through a dense lookup table.
+
+    Parameters
+    ----------
+    inp : np.ndarray
+        Integer label map.
+    table : np.ndarray
+        Lookup table, such that `out = table[inp]`.
+    keep_outside : bool, default=True
+        Whether labels that fall outside of the table are preserved.
+        Otherwise, they are set to zero.
+    out : np.ndarray, optional
+        Output array, with the same shape as `inp`.
+
+    Returns
+    -------
+    out : np.ndarray
+        Remapped label map, with the data type of `table` (or `out`).
+    """
+    inp = np.asarray(inp)
+    if HAS_NUMBA and inp.size >= PARALLEL_MIN_SIZE:
+        order = _order(inp)
+        if out is None:
+            out = np.empty(inp.shape, dtype=table.dtype, order=order)
+        with _flat_output(out, order) as buffer:
+            _remap_numba(inp.ravel(order), table, keep_outside, buffer)
+        return out
+
+    if inp.size and 0 <= inp.min() and inp.max() < len(table):
+        # (all labels are in the table: plain gather)
+        if out is None:
+            return table[inp]
+        out[...] = table[inp]
+        return out
+
+    # The table is only applied to the unique labels of the volume,
+    # which are then scattered back through the inverse indices.
+    labels, inverse = np.unique(inp, return_inverse=True)
+    outside = (labels < 0) | (labels >= len(table))
+    mapped = table[np.where(outside, 0, labels)]
+    if keep_outside:
+        np.copyto(mapped, labels, casting="unsafe", where=outside)
+    else:
+        mapped[outside] = 0
+    if out is None:
+        return mapped[inverse].reshape(inp.shape)
+    out[...] = mapped[inverse].reshape(inp.shape)
+    return out
+
+
+def remap_sparse(
+    inp: np.ndarray,
+    keys: np.ndarray,
+    values: np.ndarray,
+    keep_missing: bool = True,
+    out: np.ndarray | None = None,
+) -> np.ndarray:
+    """
+    Map labels through a sparse lookup table.
+
+    Parameters
+    ----------
+    inp : np.ndarray
+        Integer label map.
+    keys : np.ndarray
+        Sorted labels that are remapped.
+    values : np.ndarray
+        New labels, such that `out[inp == keys[i]] = values[i]`.
+    keep_missing : bool, default=True
+        Whether labels that are not in `keys` are preserved.
+        Otherwise, they are set to zero.
+    out : np.ndarray, optional
+        Output array, with the same shape as `inp`.
+
+    Returns
+    -------
+    out : np.ndarray
+        Remapped label map, with the data type of `values` (or `out`).
+    """
+    # (each voxel is searched for in the sorted keys, which avoids
+    #  sorting the volume itself)
+    inp = np.asarray(inp)
+    if HAS_NUMBA and inp.size >= PARALLEL_MIN_SIZE:
+        order = _order(inp)
+        if out is None:
+            out = np.empty(inp.shape, dtype=values.dtype, order=order)
+        with _flat_output(out, order) as buffer:
+            _remap_sparse_numba(
+                inp.ravel(order), keys, values, keep_missing, buffer
+            )
+        return out
+
+    if out is None:
+        out = np.empty(inp.shape, dtype=values.dtype)
+    if not len(keys):
+        out[...] = inp if keep_missing else 0
+        return out
+    index = np.searchsorted(keys, inp).clip(max=len(keys) - 1)
+    missing = keys[index] != inp
+    mapped = values[index]
+    if keep_missing:
+        np.copyto(mapped, inp, casting="unsafe", where=missing)
+    else:
+        mapped[missing] = 0
+    out[...] = mapped
+    return out
+
+
+def remap_rows(
+    rows: np.ndarray,
+    inp: np.ndarray,
+    table: np.ndarray,
+    out: np.ndarray | None = None,
+) -> np.ndarray:
+    """
+    Map labels through one of several lookup tables.
+
+    Parameters
+    ----------
+    rows : np.ndarray
+        Integer map of lookup table indices (e.g., hemisphere side).
+    inp : np.ndarray
+        Integer label map, with the same shape as `rows`.
+    table : (nrows, nlabels) np.ndarray
+        Lookup tables, such that `out = table[rows, inp]`.
+        Rows and labels that fall outside of the table map to zero.
+    out : np.ndarray, optional
+        Output array, with the same shape as `inp`.
+
+    Returns
+    -------
+    out : np.ndarray
+        Remapped label map, with the data type of `table` (or `out`).
+    """
+    rows, inp = np.asarray(rows), np.asarray(inp)
+    order = _order(inp)
+    if out is None:
+        out = np.empty(inp.shape, dtype=table.dtype, order=order)
+    if not HAS_NUMBA or inp.size < PARALLEL_MIN_SIZE:
+        nrows, nlabels = table.shape
+        outside = (rows < 0) | (rows >= nrows) | (inp < 0) | (inp >= nlabels)
+        if not outside.any():
+            out[...] = table[rows, inp]
+            return out
+        out[...] = table[np.where(outside, 0, rows), np.where(outside, 0, inp)]
+        out[outside] = 0
+        return out
+    with _flat_output(out, order) as buffer:
+        _remap_rows_numba(rows.ravel(order), inp.ravel(order), table, buffer)
+    return out
+
+
+def _order(x: np.ndarray) -> str:
+    """Memory order of an array ("F" if Fortran-contiguous, else "C")."""
+    return "F" if x.flags.f_contiguous and not x.flags.c_contiguous else "C"
+
+
+@contextmanager
+def _flat_output(out: np.ndarray, order: str = "C") -> Iterator[np.ndarray]:
+    """
+    Flat buffer, in `order`, that is written to `out` on exit.
+
+    (the kernels work on flat buffers, so a temporary buffer is only
+    used when `out` is not contiguous in the same order as the input)
+    """
+    if out.flags.f_contiguous if order == "F" else out.flags.c_contiguous:
+        yield out.ravel(order)
+        return
+    buffer = np.empty(out.shape, dtype=out.dtype, order=order)
+    yield buffer.ravel(order)
+    out[...] = buffer
+
+
+if numba is not None:
+
+    @numba.njit(parallel=True, nogil=True, cache=True)
+    def _remap_numba(
+        inp: np.ndarray,
+        table: np.ndarray,
+        keep_outside: bool,
+        out: np.ndarray,
+    ) -> None:
+        n = len(table)
+        for i in numba.prange(len(inp)):
+            label = inp[i]
+            if 0 <= label < n:
+                out[i] = table[label]
+            elif keep_outside:
+                out[i] = label
+            else:
+                out[i] = 0
+
+    @numba.njit(parallel=True, nogil=True, cache=True)
+    def _remap_rows_numba(
+        rows: np.ndarray,
+        inp: np.ndarray,
+        table: np.ndarray,
+        out: np.ndarray,
+    ) -> None:
+        nrows, nlabels = table.shape
+        for i in numba.prange(len(inp)):
+            row, label = rows[i], inp[i]
+            if 0 <= row < nrows and 0 <= label < nlabels:
+                out[i] = table[row, label]
+            else:
+                out[i] = 0
+
+    @numba.njit(parallel=True, nogil=True, cache=True)
+    def _remap_sparse_numba(
+        inp: np.ndarray,
+        keys: np.ndarray,
+        values: np.ndarray,
+        keep_missing: bool,
+        out: np.ndarray,
+    ) -> None:
+        n = len(keys)
+        for i in numba.prange(len(inp)):
+            label = inp[i]
+            j = np.searchsorted(keys, label)
+            if j < n and keys[j] == label:
+                out[i] = values[j]
+            elif keep_missing:
+                out[i] = label
+            else:
+                out[i] = 0
@@ -2,23 +2,31 @@
 __author__ = "Yael Balbastre"
 
 # std
-import os.path as op
-from itertools import product
 from pathlib import Path
+from tempfile import TemporaryFile
 
 # externals
 import nibabel as nb
 import numpy as np
 from nibabel.spatialimages import SpatialImage
 
+# internals
+from .io import SLAB_SIZE, iter_slabs, split_nii_path
+
 PathLike = str | Path
 
+# Combined volumes larger than this (in bytes) are memory-mapped, and
+# hemispheres are then read in slabs of about `SLAB_SIZE` bytes.
+MMAP_THRESHOLD = 2 * 1024**3
+
 
 def combine_hemis(
     left: PathLike | SpatialImage,
     right: PathLike | SpatialImage,
     save: PathLike | bool = True,
     save_sides: PathLike | bool = True,
+    reload: bool = False,
+    mmap: bool | None = None,
 ) -> SpatialImage:
     """
     Combine NextBrain hemispheres into a single file.
@@ -33,6 +41,13 @@ def combine_hemis(
         Whether to save the combined segmentation to disk.
     save_side: PathLike | bool = True
         Whether to save the lateralization mask to disk.
+    reload : bool, default=False
+        Whether to return images that are reloaded from the saved files
+        (i.e., backed by on-disk proxies) instead of in-memory images.
+    mmap : bool, optional
+        Whether to store the combined volumes in memory-mapped temporary
+        files, and read the hemispheres slab by slab. By default, this is
+        only done if the combined volume exceeds `MMAP_THRESHOLD` bytes.
 
     Returns
     -------
@@ -47,25 +62,22 @@ def combine_hemis(
     if isinstance(right, (str, Path)):
         right = nb.load(right)
 
-    bbox = list(product([0, 1], [0, 1], [0, 1]))
     right2left = np.linalg.inv(left.affine) @ right.affine
 
     # coordinate of the corners of the left image, in left voxel space
     left_shape = np.asarray(left.shape[:3])
-    left_bbox = np.asarray(bbox)
-    left_bbox = left_bbox * (left_shape - 1)[None, :]
-    left_bbox_min = np.round(left_bbox.min(0)).astype("i8")
-    left_bbox_max = np.round(left_bbox.max(0)).astype("i8")
+    left_bbox_min = np.zeros(3, dtype="i8")
+    left_bbox_max = left_shape.astype("i8") - 1
 
-    # coordinate of the corners of the right image, in right voxel space
+    # coordinate of the corners of the right image, in left voxel space
+    # (each output coordinate is extremal when each input coordinate sits
+    #  at the end of the range that matches the sign of the affine entry)
     right_shape = np.asarray(right.shape[:3])
-    right_bbox = np.asarray(bbox)
-    right_bbox = right_bbox * (right_shape - 1)[None, :]
-
-    # convert right corners to left voxel space
-    right_bbox = right_bbox @ right2left[:3, :3].T + right2left[:3, -1]
-    right_bbox_min = np.round(right_bbox.min(0)).astype("i8")
-    right_bbox_max = np.round(right_bbox.max(0)).astype("i8")
+    lin, off = right2left[:3, :3], right2left[:3, -1]
+    right_bbox_min = off + np.minimum(lin, 0) @ (right_shape - 1)
+    right_bbox_max = off + np.maximum(lin, 0) @ (right_shape - 1)
+    right_bbox_min = np.round(right_bbox_min).astype("i8")
+    right_bbox_max = np.round(right_bbox_max).astype("i8")
 
     # compute the shape of the combined volume
     bmin = np.minimum(left_bbox_min, right_bbox_min)
@@ -73,20 +85,17 @@ def combine_hemis(
     shape = bmax - bmin + 1
 
     # compute the bounding box of the left and right images in combined space
-    left_bbox = tuple(
-        slice(
-            int(np.round(left_bbox_min[i]-bmin[i]).item()),
-            int(np.round(left_bbox_max[i]-bmin[i]).item()) + 1
-        )
-        for i in range(3)
-    )
-    right_bbox = tuple(
-        slice(
-            int(np.round(right_bbox_min[i]-bmin[i]).item()),
-            int(np.round(right_bbox_max[i]-bmin[i]).item()) + 1
-        )
-        for i in range(3)
-    )
+    # (corners are already rounded to integers)
+    left_bbox = tuple(map(
+        slice,
+        (left_bbox_min - bmin).tolist(),
+        (left_bbox_max - bmin + 1).tolist(),
+    ))
+    right_bbox = tuple(map(
+        slice,
+        (right_bbox_min - bmin).tolist(),
+        (right_bbox_max - bmin + 1).tolist(),
+    ))
 
     # compute the affine of the combined volume
     comb2left = np.eye(4)
@@ -96,38 +105,54 @@ def combine_hemis(
     comb2right = np.eye(4)
     comb2right[:3, -1] = bmin - right_bbox_min
 
+    # allocate output volumes
+    # (hemispheres may be stored with different data types, so the output
+    #  uses a type that can hold both; assignments cast block-wise)
+    dtype = np.promote_types(left.dataobj.dtype, right.dataobj.dtype)
+    if mmap is None:
+        mmap = shape.prod() * dtype.itemsize > MMAP_THRESHOLD
+    if mmap:
+        # (temporary files are zero-filled, and the mappings outlive them)
+        with TemporaryFile() as f:
+            out = np.memmap(f, dtype=dtype, mode="w+", shape=tuple(shape))
+        with TemporaryFile() as f:
+            msk = np.memmap(f, dtype="u1", mode="w+", shape=tuple(shape))
+    else:
+        # (only zero voxels that are not overwritten by the left hemisphere)
+        out = np.empty(shape, dtype=dtype)
+        _zero_outside(out, left_bbox)
+        msk = np.zeros(shape, dtype="u1")
+
     # combine
-    out = np.zeros(shape, dtype=left.dataobj.dtype)
-    out[left_bbox] = left.dataobj
-    out[right_bbox] += right.dataobj * (out[right_bbox] == 0)
+    # (each hemisphere is read once, either whole or slab by slab.
+    #  the left label is written straight into the mask through a boolean
+    #  view, then right voxels are only written if not already labelled)
+    slab_size = SLAB_SIZE if mmap else None
+
+    out_left, msk_left = out[left_bbox], msk[left_bbox]
+    for slicer, left_arr in iter_slabs(left.dataobj, slab_size):
+        out_left[slicer] = left_arr
+        np.not_equal(left_arr, 0, out=msk_left[slicer].view(np.bool_))
+
+    out_right, msk_right = out[right_bbox], msk[right_bbox]
+    for slicer, right_arr in iter_slabs(right.dataobj, slab_size):
+        out_slab, msk_slab = out_right[slicer], msk_right[slicer]
+        np.copyto(msk_slab, 2, where=(right_arr != 0) & (msk_slab == 0))
+        np.copyto(out_slab, right_arr, where=(out_slab == 0))
 
     # create nibabel spatial object
-    out = type(left)(out, affine, left.header)
+    out_header = left.header.copy()
+    out_header.set_data_dtype(dtype)
+    out = type(left)(out, affine, out_header)
 
     # same for left/right mask
-    msk = np.zeros(shape, dtype="u1")
-    msk[left_bbox] = (np.asarray(left.dataobj) > 0) * np.uint8(1)
-    tmp = msk[right_bbox] == 0
-    msk[right_bbox] += (np.asarray(right.dataobj) > 0) * np.uint8(2) * tmp
-
-    msk_header = left.header
+    msk_header = left.header.copy()
     msk_header.set_data_dtype("u1")
     msk = type(left)(msk, affine, msk_header)
 
     if save or save_sides:
         fname = left.file_map["image"].filename
-        if isinstance(fname, str):
-            dirname = op.dirname(fname)
-            basename = op.basename(fname)
-            basename, ext = op.splitext(basename)
-            if ext in (".gz", ".bz2"):
-                compression = ext
-                basename, ext = op.splitext(basename)
-                ext += compression
-        else:
-            dirname = op.curdir
-            basename = "seg"
-            ext = ".nii.gz"
+        dirname, basename, ext = split_nii_path(fname)
         if ".left" in basename:
             basename = basename.replace(".left", ".{side}")
         else:
@@ -138,13 +163,26 @@ def combine_hemis(
             save = f"{dirname}/{basename}{ext}"
             save = save.format(side="combined")
         nb.save(out, save)
-        out = nb.load(save)
+        if reload:
+            out = nb.load(save)
 
     if save_sides:
         if save_sides is True:
             save_sides = f"{dirname}/{basename}{ext}"
             save_sides = save_sides.format(side="sides")
         nb.save(msk, save_sides)
-        msk = nb.load(save_sides)
+        if reload:
+            msk = nb.load(save_sides)
 
     return out, msk
+
+
+def _zero_outside(x: np.ndarray, bbox: tuple[slice, ...]) -> None:
+    """Zero all voxels of `x` that lie outside of a bounding box."""
+    # The complement of the box is covered by (at most) two slabs per
+    # dimension, each restricted to the box along previous dimensions.
+    inside = ()
+    for slicer in bbox:
+        x[inside + (slice(None, slicer.start),)] = 0
+        x[inside + (slice(slicer.stop, None),)] = 0
+        inside += (slicer,)
@@ -1,22 +1,49 @@
 """Load ontology and lookup tables."""
 # stdlib
 import json
+import os
 import os.path as op
+import re
+from functools import cached_property
+from io import BytesIO
 from pathlib import Path
+from typing import Callable, Iterator, TypeVar
 
 # externals
 import numpy as np
 import yaml
+from numpy.lib.recfunctions import structured_to_unstructured
+from numpy.typing import ArrayLike, DTypeLike
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 PATH_ALLEN = op.join(op.dirname(__file__), "lut", "AllenBrainOntologyDev.json")
 PATH_NEXTBRAIN = op.join(op.dirname(__file__), "lut", "NextBrainLUT.txt")
 
+# Volumes are read and remapped in slabs of about this many bytes.
+SLAB_SIZE = 256 * 1024**2
+
 PathLike = str | Path
+T = TypeVar("T")
 ColorRGB = tuple[int, int, int]
 ColorRGBA = tuple[int, int, int, int]
 Color = ColorRGB | ColorRGBA
 
 LUT_DTYPE = np.dtype([
+    ("ID", "i8"),
+    ("NAME", "S256"),
+    ("R", "u1"),
+    ("G", "u1"),
+    ("B", "u1"),
+    ("A", "u1"),
+])
+
+# A few rows of the NextBrain LUT have color values above 255, so files
+# are parsed with wide color fields first, then wrapped to uint8.
+_LUT_TEXT_DTYPE = np.dtype([
     ("ID", "i8"),
     ("NAME", "S256"),
     ("R", "u8"),
@@ -25,6 +52,14 @@ LUT_DTYPE = np.dtype([
     ("A", "u8"),
 ])
 
+# Rows are parsed with a single regex, which ignores any extra columns
+# found after the alpha channel in some lookup tables.
+_LUT_ROW = re.compile(
+    rb"^[ \t]*(-?\d+)[ \t]+(\S+)[ \t]+(\d+)[ \t]+(\d+)[ \t]+(\d+)[ \t]+(\d+)",
+    re.MULTILINE,
+)
+_LUT_COMMENT = re.compile(rb"#[^\n]*")
+
 
 def load_yaml(fname: PathLike) -> dict:
     """Load a YAML file."""
@@ -35,32 +70,163 @@ def load_yaml(fname: PathLike) -> dict:
 
 def load_json(fname: PathLike) -> dict:
     """Load a JSON file."""
+    if orjson is not None:
+        with open(fname, "rb") as f:
+            return orjson.loads(f.read())
     with open(fname) as f:
         data = json.load(f)
     return data
 
 
+# Parsed files, keyed by (parser, absolute path) and tagged with the
+# modification time of the file when it was parsed.
+_CACHE: dict[tuple[Callable, str], tuple[int, object]] = {}
+
+
+def _load_cached(parse: Callable[[PathLike], T], fname: PathLike) -> T:
+    """Parse a file, or return its cached content if it has not changed."""
+    key = (parse, op.abspath(fname))
+    mtime = os.stat(fname).st_mtime_ns
+    if key not in _CACHE or _CACHE[key][0] != mtime:
+        _CACHE[key] = (mtime, parse(fname))
+    return _CACHE[key][1]
+
+
 def load_ontology(fname: PathLike = PATH_ALLEN) -> np.ndarray:
-    """Load the allen ontology in JSON format."""
-    return load_json(fname)
+    """
+    Load the allen ontology in JSON format.
+
+    The parsed ontology is cached and shared between calls,
+    so it must not be modified in-place.
+    """
+    return _load_cached(load_json, fname)
 
 
 def load_lut(fname: PathLike = PATH_NEXTBRAIN) -> "LUT":
-    """Load the nextbrain lookup in numpy format."""
-    text = []
-    with open(fname) as f:
-        for line in f:
-            line = line.split("#")[0].strip()
-            if not line:
-                continue
-            label, name, *color = line.split()
-            label, *color = map(int, (label, *color))
-            text.append((label, name, *color[:4]))
+    """
+    Load the nextbrain lookup in numpy format.
+
+    The parsed table is cached and shared between calls,
+    so it is read-only.
+    """
+    return _load_cached(_parse_lut, fname)
+
+
+def iter_slabs(
+    dat: ArrayLike, slab_size: int | None = SLAB_SIZE
+) -> Iterator[tuple[tuple, np.ndarray]]:
+    """
+    Yield (slicer, data) pairs that cover an array along its last axis.
+
+    Parameters
+    ----------
+    dat : array_like
+        Array, or array proxy (e.g., `SpatialImage.dataobj`).
+        Proxies are only read one slab at a time.
+    slab_size : int, optional
+        Approximate number of bytes per slab.
+        If None, the whole array is read at once.
+    """
+    if not hasattr(dat, "shape"):
+        dat = np.asarray(dat)
+    if slab_size is None or len(dat.shape) == 0:
+        yield (Ellipsis,), np.asarray(dat)
+        return
+    *shape, length = dat.shape
+    slab_bytes = np.prod(shape, dtype=int) * dat.dtype.itemsize
+    step = max(1, slab_size // max(1, slab_bytes))
+    for start in range(0, length, step):
+        slicer = (Ellipsis, slice(start, start + step))
+        yield slicer, np.asarray(dat[slicer])
+
+
+def map_slabs(
+    func: Callable[..., np.ndarray],
+    *dats: ArrayLike,
+    dtype: DTypeLike,
+    out: np.ndarray | None = None,
+) -> np.ndarray:
+    """
+    Apply a label mapping to one or more volumes, slab by slab.
 
-    lut = np.ndarray([len(text)], dtype=LUT_DTYPE)
-    for i, line in enumerate(text):
-        lut[i] = line
-    return lut.view(LUT)
+    The volumes are read and mapped one slab at a time, so that the
+    inputs and the output are never all fully in memory.
+
+    Parameters
+    ----------
+    func : callable
+        Called as `func(*slabs, out=out_slab)`. Floating point (e.g.,
+        scaled) slabs are rounded to integer labels first.
+    *dats : array_like
+        Arrays, or array proxies, with the same shape.
+        The output is laid out in the memory order of the first one.
+    dtype : dtype_like
+        Output data type, if `out` is not provided.
+    out : np.ndarray, optional
+        Output array.
+
+    Returns
+    -------
+    out : np.ndarray
+        Mapped volume.
+    """
+    dat, *others = [x if hasattr(x, "shape") else np.asarray(x) for x in dats]
+    if out is None:
+        out = np.empty(dat.shape, dtype=dtype, order=memory_order(dat))
+    elif np.shape(out) != dat.shape:
+        raise ValueError("Output and input shapes do not match.")
+    for slicer, slab in iter_slabs(dat):
+        slabs = [slab, *(np.asarray(other[slicer]) for other in others)]
+        func(*map(_as_labels, slabs), out=out[slicer])
+    return out
+
+
+def _as_labels(slab: np.ndarray) -> np.ndarray:
+    """Round floating point slabs to integer labels."""
+    if slab.dtype.kind == "f":
+        return np.rint(slab).astype(np.intp)
+    return slab
+
+
+def memory_order(dat: ArrayLike) -> str:
+    """
+    Memory order ("C" or "F") in which an array, or proxy, is read.
+
+    (nibabel proxies read volumes in Fortran order, so that allocating
+    outputs in the same order keeps their slabs contiguous)
+    """
+    if isinstance(dat, np.ndarray):
+        fortran = dat.flags.f_contiguous and not dat.flags.c_contiguous
+        return "F" if fortran else "C"
+    return getattr(dat, "order", "C")
+
+
+def split_nii_path(fname: PathLike | None) -> tuple[str, str, str]:
+    """
+    Split an image filename into (dirname, basename, ext).
+
+    Compressed extensions are kept whole (e.g., ".nii.gz").
+    If `fname` is not a path, the default `(".", "seg", ".nii.gz")`
+    is returned.
+    """
+    if not isinstance(fname, (str, Path)):
+        return op.curdir, "seg", ".nii.gz"
+    dirname, basename = op.split(fname)
+    basename, ext = op.splitext(basename)
+    if ext in (".gz", ".bz2"):
+        basename, compressed_ext = op.splitext(basename)
+        ext = compressed_ext + ext
+    return dirname or op.curdir, basename, ext
+
+
+def _parse_lut(fname: PathLike) -> "LUT":
+    """Parse a lookup table file."""
+    with open(fname, "rb") as f:
+        data = _LUT_COMMENT.sub(b"", f.read())
+    lut = np.fromregex(BytesIO(data), _LUT_ROW, dtype=_LUT_TEXT_DTYPE)
+    lut = np.atleast_1d(lut).astype(LUT_DTYPE).view(LUT)
+    lut.flags.writeable = False
+    return lut
 
 
 class LUT(np.ndarray):
@@ -71,54 +237,70 @@ class LUT(np.ndarray):
         """Load a lookup table from file."""
         return load_lut(fname)
 
-    @property
+    # The attributes below are computed once per instance, so the table
+    # must not be modified in-place after they have been accessed.
+    # When a label or name appears multiple times, lookups return the
+    # first entry.
+
+    @cached_property
     def labels(self) -> list[int]:
         """Get label IDs."""
         return self["ID"].tolist()
 
-    @property
+    @cached_property
     def names(self) -> list[str]:
         """Get label names."""
         return [name.decode("utf-8") for name in self["NAME"].tolist()]
 
-    @property
+    @cached_property
     def colors(self) -> np.ndarray:
         """Get label colors."""
-        return self[["R", "G", "B", "A"]].astype("u1")
+        # The color fields are contiguous uint8, so this is a view.
+        rgba = structured_to_unstructured(
+            np.asarray(self)[["R", "G", "B", "A"]]
+        )
+        rgba.flags.writeable = False
+        return rgba
+
+    @cached_property
+    def _id2idx(self) -> dict[int, int]:
+        """Map label IDs to row indices."""
+        index = {}
+        for i, label in enumerate(self.labels):
+            index.setdefault(label, i)
+        return index
+
+    @cached_property
+    def _name2idx(self) -> dict[str, int]:
+        """Map label names to row indices."""
+        index = {}
+        for i, name in enumerate(self.names):
+            index.setdefault(name, i)
+        return index
 
     def label2name(self, label: int | None = None) -> dict[int, str] | str:
         """Get mapping from label IDs to names."""
         if label is not None:
-            return self[self["ID"] == label]["NAME"][0].decode("utf-8")
+            return self.names[self._id2idx[label]]
 
-        return {
-            int(lab): name.decode("utf-8")
-            for lab, name in zip(self["ID"], self["NAME"])
-        }
+        return dict(zip(self.labels, self.names))
 
     def name2label(self, name: str | None = None) -> dict[str, int] | int:
         """Get mapping from label names to IDs."""
         if name is not None:
-            return int(self[self["NAME"] == name.encode("utf-8")]["ID"][0])
+            return self.labels[self._name2idx[name]]
 
-        return {
-            name.decode("utf-8"): int(lab)
-            for lab, name in zip(self["ID"], self["NAME"])
-        }
+        return dict(zip(self.names, self.labels))
 
     def label2color(
         self, label: int | None = None
     ) -> dict[int, ColorRGBA] | ColorRGBA:
         """Get mapping from label IDs to colors."""
         if label is not None:
-            color = (
-                self[self["ID"] == label][["R", "G", "B", "A"]]
-                .astype("u1")[0]
-            )
-            return tuple(color)
+            return tuple(self.colors[self._id2idx[label]].tolist())
         return {
             int(lab): tuple(color)
-            for lab, color in zip(self.labels, self.colors)
+            for lab, color in zip(self.labels, self.colors.tolist())
         }
 
     def name2color(
@@ -126,12 +308,9 @@ class LUT(np.ndarray):
     ) -> dict[str, ColorRGBA] | ColorRGBA:
         """Get mapping from label names to colors."""
         if name is not None:
-            color = self[
-                self["NAME"] == name.encode("utf-8")
-            ][["R", "G", "B", "A"]].astype("u1")[0]
-            return tuple(color)
+            return tuple(self.colors[self._name2idx[name]].tolist())
 
         return {
             name: tuple(color)
-            for name, color in zip(self.names, self.colors)
+            for name, color in zip(self.names, self.colors.tolist())
         }
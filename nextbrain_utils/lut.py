@@ -2,11 +2,16 @@
 __author__ = "Yael Balbastre"
 
 # std
-import json
 import os.path as op
 from pathlib import Path
 from typing import Iterator, TextIO
 
+# externals
+import numpy as np
+
+# internals
+from .io import load_lut, load_ontology
+
 PATH_ALLEN = op.join(op.dirname(__file__), "lut", "AllenBrainOntologyDev.json")
 PATH_NEXTBRAIN = op.join(op.dirname(__file__), "lut", "NextBrainLUT.txt")
 
@@ -72,10 +77,13 @@ def make_allen_lut(
     compat16bits: bool = False,
 ) -> Iterator[tuple[int, str, int, int, int, int]]:
     """Generate lines of a freesurfer lookup table from the Allen ontology."""
-    with open(fname) as f:
-        allen_ontology = json.load(f)
+    allen_ontology = load_ontology(fname)
 
-    def recurse(ont: dict) -> Iterator[list[int | str]]:
+    # iterative preorder walk; children are pushed in reverse order so
+    # that they are visited in order
+    stack = [allen_ontology]
+    while stack:
+        ont = stack.pop()
         name = ont["acronym" if acronym else "name"]
         name = name.replace(" ", "_")
         label = ont["id"]
@@ -92,10 +100,7 @@ def make_allen_lut(
 
         r, g, b = _hex2rgb(ont["color_hex_triplet"])
         yield (label, name, r, g, b, 0)
-        for child in ont.get("children", []):
-            yield from recurse(child)
-
-    yield from recurse(allen_ontology)
+        stack.extend(reversed(ont.get("children", [])))
 
 
 def make_dk_lut(
@@ -105,17 +110,24 @@ def make_dk_lut(
     Generate lines of a freesurfer lookup table containing only
     Desikan-Killiany labels.
     """
-    with open(fname) as f:
-        for line in f:
-            line = line.strip().split("#")[0].strip()
-            if not f:
-                continue
-            label, name, r, g, b, a = line.split()
-            if name.startswith("ctx-rh-"):
-                name = "ctx-" + name[7:]
-                label = int(label)
-                r, g, b, a = map(int, (r, g, b, a))
-                yield (label, name, r, g, b, a)
+    lut = np.asarray(load_lut(fname))
+
+    # NextBrain always uses RH labels, which may be stored as either
+    # "ctx-<name>" or "ctx-rh-<name>".
+    names = lut["NAME"]
+    mask = np.char.startswith(names, b"ctx-")
+    mask &= ~np.char.startswith(names, b"ctx-lh-")
+    lut = lut[mask]
+    names = np.char.replace(lut["NAME"], b"ctx-rh-", b"ctx-", count=1)
+
+    yield from zip(
+        lut["ID"].tolist(),
+        (name.decode("utf-8") for name in names.tolist()),
+        lut["R"].tolist(),
+        lut["G"].tolist(),
+        lut["B"].tolist(),
+        lut["A"].tolist(),
+    )
 
 
 def _hex2rgb(hex: str) -> tuple[int, int, int]:
@@ -2,7 +2,7 @@
 __author__ = "Yael Balbastre"
 
 # std
-import os.path as op
+from functools import partial
 from pathlib import Path
 
 # externals
@@ -12,11 +12,15 @@ from nibabel.spatialimages import SpatialImage
 from numpy.typing import ArrayLike
 
 # internals
-from .io import load_ontology
+from ._kernels import remap, remap_sparse
+from .io import load_ontology, map_slabs, split_nii_path
 from .to_allen import normalize_name
 
 PathLike = str | Path
 
+# Sparse maps whose largest label is below this are expanded to a table.
+DENSE_MAX_LABEL = 1 << 22
+
 
 def simplify(
     allen: PathLike | SpatialImage | ArrayLike,
@@ -59,8 +63,11 @@ def simplify(
     else:
         allen_dat = allen
 
-    # prepare linear label maps
-    allen2simple = get_allen2simple_map(labels, hide_missing)
+    # prepare sparse label map
+    # (only collapsed labels are listed; all other labels are either
+    #  erased or preserved, depending on `hide_missing`)
+    allen2simple = _get_allen2simple_dict(labels)
+    dtype = "i4"
 
     if compat16bits:
         # Most Allen labels use 5 digits (e.g. 10962)
@@ -78,61 +85,55 @@ def simplify(
         # However, the range [1000, 3000] is already used by the
         # DK cortical labels, so we also remap the range prefixed
         # by 26644 to [3000, 4000] instead..
-        prefix_146035 = (allen2simple // 1000) == 146035
-        prefix_146034 = (allen2simple // 1000) == 146034
-        prefix_266441 = (allen2simple // 1000) == 266441
-        prefix_267499 = (allen2simple // 1000) == 267499
+        allen2simple = _fold16(allen2simple)
+        dtype = "i2"
 
-        allen2simple[prefix_146035] -= 146035000
-        allen2simple[prefix_146034] -= 146034000
-        allen2simple[prefix_266441] -= (266440000 - 2000)
-        allen2simple[prefix_267499] -= 267490000
+    items = sorted(allen2simple.items())
+    keys = np.asarray([key for key, _ in items], dtype="i8")
+    values = np.asarray([value for _, value in items], dtype="i8").astype(dtype)
 
-        allen2simple[:200] = allen2simple[146035000:146035200]
-        allen2simple[600:1000] = allen2simple[146034600:146035000]
-        allen2simple[3000:4000] = allen2simple[266441000:266442000]
-        allen2simple[9000:10000] = allen2simple[267499000:267500000]
-
-        allen2simple = allen2simple[:32768].astype('i2')
+    # (maps whose labels are all small, such as the 16 bits map, are
+    #  expanded into a dense table; otherwise labels are searched for)
+    if not len(keys) or keys[-1] < DENSE_MAX_LABEL:
+        length = int(keys[-1]) + 1 if len(keys) else 1
+        if hide_missing:
+            table = np.zeros([length], dtype=dtype)
+        else:
+            table = np.arange(length).astype(dtype)
+        table[keys] = values
+        func = partial(remap, table=table, keep_outside=not hide_missing)
+    else:
+        func = partial(
+            remap_sparse, keys=keys, values=values, keep_missing=not hide_missing
+        )
 
     # perform mapping
-    simple_dat = allen2simple[np.asarray(allen_dat)]
+    simple_dat = map_slabs(func, allen_dat, dtype=dtype)
 
     # make SpatialImage
     if isinstance(allen, SpatialImage):
-        header = allen.header
+        header = allen.header.copy()
         header.set_data_dtype(allen_dat.dtype)
-        simple = type(allen)(simple_dat, None, header)
+        simple = type(allen)(simple_dat, allen.affine, header)
     else:
-        simple = nb.Nifti1Image(simple_dat)
+        simple = nb.Nifti1Image(simple_dat, np.eye(4))
 
     # save
     if save:
         fname = None
         if isinstance(allen, SpatialImage):
             fname = allen.file_map["image"].filename
-        if isinstance(fname, str):
-            dirname = op.dirname(fname)
-            basename = op.basename(fname)
-            basename, ext = op.splitext(basename)
-            if ext in (".gz", ".bz2"):
-                compression = ext
-                basename, ext = op.splitext(basename)
-                ext += compression
-        else:
-            dirname = op.curdir
-            basename = "seg"
-            ext = ".nii.gz"
+        dirname, basename, ext = split_nii_path(fname)
         basename += ".simplified"
 
         if save is True:
             save = f"{dirname}/{basename}{ext}"
 
+        # (the in-memory image is returned, rather than reloading it)
         nb.save(simple, save)
-        simple = nb.load(save)
 
     # return
-    if isinstance(simple, SpatialImage):
+    if isinstance(allen, SpatialImage):
         return simple
     else:
         return simple_dat
@@ -141,9 +142,29 @@ def simplify(
 def get_allen2simple_map(
     labels: list[int | str],
     hide_missing: bool = False,
+    *,
     verbose: bool = False,
 ) -> np.ndarray:
     """Compute linear label maps."""
+    allen2simple = _get_allen2simple_dict(labels, verbose)
+
+    # prepare linear label maps
+    # (the length is rounded up to a multiple of 1000 so that all blocks
+    #  used by the 16 bits compatibility mode are complete)
+    length = -(-(_max_id(load_ontology()) + 1) // 1000) * 1000
+    if hide_missing:
+        table = np.zeros([length], dtype="i4")
+    else:
+        table = np.arange(length, dtype="i4")
+    table[list(allen2simple.keys())] = list(allen2simple.values())
+    return table
+
+
+def _get_allen2simple_dict(
+    labels: list[int | str],
+    verbose: bool = False,
+) -> dict[int, int]:
+    """Compute sparse label map (collapsed label -> parent label)."""
     # convert integer-like labels to integers
     labels, _ = [], labels
     for label in _:
@@ -152,41 +173,84 @@ def get_allen2simple_map(
         except ValueError:
             ...
         labels.append(label)
+    labels = set(labels)
 
     # load lookup tables
     allen_ont = load_ontology()
-    allen_dtype = 'i4'
-
-    # prepare linear label maps
-    if hide_missing:
-        allen2simple = np.zeros([2**29], dtype=allen_dtype)
-    else:
-        allen2simple = np.arange(2**29, dtype=allen_dtype)
 
     # Map NextBrain labels to Allen labels
-    def _recurse_map(ont: dict, target: int) -> None:
-        allen2simple[ont['id']] = target
-        for child in ont.get("children", []):
-            _recurse_map(child, target)
-
-    def _recurse(ont: dict) -> None:
+    # (iterative preorder walk; children are pushed in reverse order so
+    #  that they are visited in order)
+    allen2simple = {}
+    stack = [allen_ont]
+    while stack:
+        ont = stack.pop()
         id = ont["id"]
         acronym = ont["acronym"]
         name = ont["name"]
         name_norm = normalize_name(name)
-        if (
-            (acronym in labels) or
-            (name in labels) or
-            (name_norm in labels) or
-            (id in labels)
-        ):
+        if not labels.isdisjoint((acronym, name, name_norm, id)):
             if verbose:
                 print(ont["name"] + ":")
-            _recurse_map(ont, ont['id'])
+            allen2simple.update(dict.fromkeys(_subtree_ids(ont), id))
         else:
-            for child in ont.get("children", []):
-                _recurse(child)
-
-    _recurse(allen_ont)
+            stack.extend(reversed(ont.get("children", [])))
 
     return allen2simple
+
+
+def _subtree_ids(ont: dict) -> list[int]:
+    """Label IDs of a node and all its descendants."""
+    ids, stack = [], [ont]
+    while stack:
+        node = stack.pop()
+        ids.append(node["id"])
+        stack.extend(node.get("children", []))
+    return ids
+
+
+def _max_id(ont: dict) -> int:
+    """Largest label ID in an ontology."""
+    max_id, stack = 0, [ont]
+    while stack:
+        node = stack.pop()
+        max_id = max(max_id, node["id"])
+        stack.extend(node.get("children", []))
+    return max_id
+
+
+# (prefix, [start, stop) of folded labels, offset) of each 16 bits block
+_COMPAT16_BLOCKS = (
+    (146035, (0, 200), 146035000),
+    (146034, (600, 1000), 146034000),
+    (266441, (3000, 4000), 266440000 - 2000),
+    (267499, (9000, 10000), 267490000),
+)
+
+
+def _fold16(allen2simple: dict[int, int]) -> dict[int, int]:
+    """Fold the prefixed blocks of a sparse label map below 32768."""
+
+    def fold_value(value: int) -> int:
+        for prefix, _, offset in _COMPAT16_BLOCKS:
+            if value // 1000 == prefix:
+                return value - offset
+        return value
+
+    def fold_key(key: int) -> int | None:
+        # (labels in the folded ranges are replaced by the prefixed
+        #  ones, and labels that do not fit in 16 bits are dropped)
+        for _, (start, stop), _ in _COMPAT16_BLOCKS:
+            if start <= key < stop:
+                return None
+        for _, (start, stop), offset in _COMPAT16_BLOCKS:
+            if start <= key - offset < stop:
+                return key - offset
+        return key if 0 <= key < 32768 else None
+
+    folded = {}
+    for key, value in allen2simple.items():
+        key = fold_key(key)
+        if key is not None:
+            folded[key] = fold_value(value)
+    return folded
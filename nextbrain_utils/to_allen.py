@@ -2,10 +2,15 @@
 __author__ = "Yael Balbastre, Laura Boettcher"
 
 # std
+import hashlib
+import os
 import os.path as op
-import re
+from collections import defaultdict
 from enum import StrEnum
+from functools import lru_cache, partial
 from pathlib import Path
+from tempfile import NamedTemporaryFile
+from types import MappingProxyType
 
 # externals
 import nibabel as nb
@@ -13,13 +18,25 @@ import numpy as np
 from nibabel.spatialimages import SpatialImage
 from numpy.typing import ArrayLike
 
-from nextbrain_utils.io import load_lut, load_ontology
+from nextbrain_utils._kernels import remap
+from nextbrain_utils.io import load_lut, load_ontology, map_slabs, split_nii_path
 
 PATH_ALLEN = op.join(op.dirname(__file__), "lut", "AllenBrainOntologyDev.json")
 PATH_NEXTBRAIN = op.join(op.dirname(__file__), "lut", "NextBrainLUT.txt")
 
 PathLike = str | Path
 
+# Allen label prefixes removed in 16 bits compatibility mode (sorted),
+# and the offsets that remove them.
+_COMPAT16_PREFIXES = np.array([146034, 146035, 266441, 267499])
+_COMPAT16_OFFSETS = np.array(
+    [146034000, 146035000, 266440000 - 2000, 267490000]
+)
+
+# Bump when the way label maps are computed changes, so that maps
+# stored on disk by previous versions are not reused.
+_CACHE_VERSION = 2
+
 
 class CortexOntology(StrEnum):
     """Ontology to use for cortical labels."""
@@ -33,7 +50,8 @@ def to_allen(
     nextbrain: PathLike | SpatialImage | ArrayLike,
     ontology: CortexOntology | str = CortexOntology.gyral,
     compat16bits: bool = False,
-    save: PathLike | bool = False
+    save: PathLike | bool = False,
+    out: np.ndarray | None = None,
 ) -> SpatialImage | np.ndarray:
     """
     Convert NextBrain labels to Allen ontology labels.
@@ -52,6 +70,10 @@ def to_allen(
         (i.e. limit maximum label ID to 32768).
     save:  PathLike | bool = True
         Whether to save the converted segmentation to disk.
+    out : np.ndarray, optional
+        Preallocated output array, with the same shape as the input
+        (e.g., to reuse a buffer across subjects).
+        Its data type is that of the output labels.
 
     Returns
     -------
@@ -70,72 +92,37 @@ def to_allen(
         nextbrain_dat = nextbrain
 
     # prepare linear label maps
-    nextbrain2allen = get_nextbrain2allen_map(ontology)
-
-    if compat16bits:
-        # Most Allen labels use 5 digits (e.g. 10962)
-        # - Some labels use the prefix 146035, followed by 3 digits.
-        #   All suffixes are below between [0, 199].
-        # - Some labels use the prefix 146034, followed by 3 digits.
-        #   All suffixes are below between [600, 999].
-        # - Some labels use the prefix 26644, followed by 4 digits.
-        #   All suffixes are below between [1000, 1999].
-        # - Some labels use the prefix 26749, followed by 4 digits.
-        #   All suffixes are between [9000, 9999].
-        # We can safely remove these two prefixes, ensuring that
-        # labels remain unique and below 32768.
-        #
-        # However, the range [1000, 3000] is already used by the
-        # DK cortical labels, so we also remap the range prefixed
-        # by 26644 to [3000, 4000] instead..
-        prefix_146035 = (nextbrain2allen // 1000) == 146035
-        prefix_146034 = (nextbrain2allen // 1000) == 146034
-        prefix_266441 = (nextbrain2allen // 1000) == 266441
-        prefix_267499 = (nextbrain2allen // 1000) == 267499
-
-        nextbrain2allen[prefix_146035] -= 146035000
-        nextbrain2allen[prefix_146034] -= 146034000
-        nextbrain2allen[prefix_266441] -= (266440000 - 2000)
-        nextbrain2allen[prefix_267499] -= 267490000
-
-        nextbrain2allen = nextbrain2allen.astype('i2')
+    nextbrain2allen = get_nextbrain2allen_map(ontology, compat16bits)
 
     # perform mapping
-    allen_dat = nextbrain2allen[np.asarray(nextbrain_dat)]
+    # (labels that are not in the map are set to zero)
+    func = partial(remap, table=nextbrain2allen, keep_outside=False)
+    allen_dat = map_slabs(
+        func, nextbrain_dat, dtype=nextbrain2allen.dtype, out=out
+    )
 
     # make SpatialImage
     if isinstance(nextbrain, SpatialImage):
-        header = nextbrain.header
+        header = nextbrain.header.copy()
         header.set_data_dtype(allen_dat.dtype)
-        allen = type(nextbrain)(allen_dat, None, header)
+        allen = type(nextbrain)(allen_dat, nextbrain.affine, header)
     else:
-        allen = nb.Nifti1Image(allen_dat)
+        allen = nb.Nifti1Image(allen_dat, np.eye(4))
 
     # save
     if save:
         fname = None
         if isinstance(nextbrain, SpatialImage):
             fname = nextbrain.file_map["image"].filename
-        if isinstance(fname, str):
-            dirname = op.dirname(fname)
-            basename = op.basename(fname)
-            basename, ext = op.splitext(basename)
-            if ext in (".gz", ".bz2"):
-                compression = ext
-                basename, ext = op.splitext(basename)
-                ext += compression
-        else:
-            dirname = op.curdir
-            basename = "seg"
-            ext = ".nii.gz"
+        dirname, basename, ext = split_nii_path(fname)
         basename += ".{ontology}"
 
         if save is True:
             save = f"{dirname}/{basename}{ext}"
             save = save.format(ontology=str(ontology))
 
+        # (the in-memory image is returned, rather than reloading it)
         nb.save(allen, save)
-        allen = nb.load(save)
 
     # return
     if isinstance(nextbrain, SpatialImage):
@@ -145,11 +132,106 @@ def to_allen(
 
 
 def get_nextbrain2allen_map(
-    cortex_ontology: CortexOntology = CortexOntology.gyral
+    cortex_ontology: CortexOntology = CortexOntology.gyral,
+    compat16bits: bool = False,
 ) -> np.ndarray:
-    """Compute linear label maps."""
+    """
+    Compute linear label maps.
+
+    The returned array is cached for later calls, and is read-only.
+
+    Parameters
+    ----------
+    cortex_ontology : CortexOntology | str = CortexOntology.gyral
+        Ontology to use for cortical labels.
+    compat16bits : bool = False
+        Whether to convert labels to be compatible with int16.
+    """
     cortex_ontology = _ensure_cortex_onto(cortex_ontology)
+    if compat16bits:
+        return _get_nextbrain2allen16_map(cortex_ontology)
+    return _get_nextbrain2allen_map(cortex_ontology)
+
+
+@lru_cache(maxsize=len(CortexOntology))
+def _get_nextbrain2allen16_map(cortex_ontology: CortexOntology) -> np.ndarray:
+    nextbrain2allen = _get_nextbrain2allen_map(cortex_ontology)
+
+    # Most Allen labels use 5 digits (e.g. 10962)
+    # - Some labels use the prefix 146035, followed by 3 digits.
+    #   All suffixes are below between [0, 199].
+    # - Some labels use the prefix 146034, followed by 3 digits.
+    #   All suffixes are below between [600, 999].
+    # - Some labels use the prefix 26644, followed by 4 digits.
+    #   All suffixes are below between [1000, 1999].
+    # - Some labels use the prefix 26749, followed by 4 digits.
+    #   All suffixes are between [9000, 9999].
+    # We can safely remove these two prefixes, ensuring that
+    # labels remain unique and below 32768.
+    #
+    # However, the range [1000, 3000] is already used by the
+    # DK cortical labels, so we also remap the range prefixed
+    # by 26644 to [3000, 4000] instead..
+    prefix = nextbrain2allen // 1000
+    index = np.searchsorted(_COMPAT16_PREFIXES, prefix)
+    index = index.clip(max=len(_COMPAT16_PREFIXES) - 1)
+    offset = np.where(
+        _COMPAT16_PREFIXES[index] == prefix, _COMPAT16_OFFSETS[index], 0
+    )
+    nextbrain2allen = (nextbrain2allen - offset).astype('i2')
+
+    nextbrain2allen.flags.writeable = False
+    return nextbrain2allen
+
 
+@lru_cache(maxsize=len(CortexOntology))
+def _get_nextbrain2allen_map(cortex_ontology: CortexOntology) -> np.ndarray:
+    # The map only depends on files shipped with the package, so it is
+    # stored on disk, under a name that hashes their content.
+    digest = hashlib.blake2b(digest_size=8)
+    for fname in (PATH_NEXTBRAIN, PATH_ALLEN):
+        with open(fname, "rb") as f:
+            digest.update(f.read())
+    digest.update(f"{cortex_ontology}:{_CACHE_VERSION}".encode())
+    # (the code-side tables used to build the map are hashed as well,
+    #  so that editing them never serves a stale map)
+    cortex_map = _CORTEX_MAPS.get(cortex_ontology, {})
+    digest.update(repr(sorted(cortex_map.items())).encode())
+    digest.update(repr(sorted(_NAME_TABLE.items())).encode())
+    digest.update(normalize_name.__wrapped__.__code__.co_code)
+    fname = f"nextbrain2allen_{cortex_ontology.name}_{digest.hexdigest()}.npy"
+    fname = op.join(_cache_dir(), fname)
+
+    # (missing, truncated or corrupt maps are rebuilt and overwritten)
+    try:
+        nextbrain2allen = np.load(fname)
+    except (ValueError, OSError, EOFError):
+        pass
+    else:
+        nextbrain2allen.flags.writeable = False
+        return nextbrain2allen
+
+    nextbrain2allen = _make_nextbrain2allen_map(cortex_ontology)
+
+    # (write to a uniquely named temporary file first, so that concurrent
+    #  processes or threads never load a partially written map)
+    tmp = None
+    try:
+        os.makedirs(op.dirname(fname), exist_ok=True)
+        with NamedTemporaryFile(
+            dir=op.dirname(fname), suffix=".tmp", delete=False
+        ) as f:
+            tmp = f.name
+            np.save(f, nextbrain2allen)
+        os.replace(tmp, fname)
+    except OSError:
+        if tmp is not None and op.exists(tmp):
+            os.remove(tmp)
+
+    return nextbrain2allen
+
+
+def _make_nextbrain2allen_map(cortex_ontology: CortexOntology) -> np.ndarray:
     # load lookup tables
     nextbrain_lut = load_lut()
     allen_ont = load_ontology()
@@ -160,46 +242,74 @@ def get_nextbrain2allen_map(
     nextbrain2allen = np.arange(max_nextbrain_label+1, dtype=allen_dtype)
 
     # normalize nextbrain names
+    # (nextbrain always uses RH labels, so LH cortical rows are skipped)
+    keep = ~np.char.startswith(nextbrain_lut["NAME"], b"ctx-lh-")
+    nextbrain_labels = nextbrain_lut["ID"][keep].tolist()
+    nextbrain_names = np.char.decode(nextbrain_lut["NAME"][keep]).tolist()
     nextbrain_norm = {
-        elem: normalize_name(elem)
-        for elem in nextbrain_lut.names
-        if not elem.startswith("ctx-lh-")  # nextbrain always uses RH labels
+        elem: normalize_name(elem) for elem in nextbrain_names
     }
 
     # hand-fix cortical names
-    if cortex_ontology == CortexOntology.gyral:
-        cortex_map = _fscortex_to_allen_gyral()
-    elif cortex_ontology == CortexOntology.developmental:
-        cortex_map = _fscortex_to_allen_dev()
-    else:
-        cortex_map = None
+    cortex_map = _CORTEX_MAPS.get(cortex_ontology)
     if cortex_map:
         for key in nextbrain_norm.keys():
             if key.startswith("ctx-"):
-                nextbrain_norm[key] = cortex_map[key[7:]]
+                # (strip the "ctx-" and optional hemisphere prefixes)
+                target = cortex_map[normalize_name(key)]
+                nextbrain_norm[key] = normalize_name(target)
+
+    # index NextBrain labels by normalized name
+    norm2labels = defaultdict(list)
+    for label, name in zip(nextbrain_labels, nextbrain_names):
+        norm2labels[nextbrain_norm[name]].append(label)
+    norm2labels = {
+        norm: np.asarray(labels) for norm, labels in norm2labels.items()
+    }
 
     # Map NextBrain labels to Allen labels
-    def _recurse(ont: dict) -> None:
-        allen_norm = normalize_name(ont["name"])
-        for nxb_orig, nbx_norm in nextbrain_norm.items():
-            if allen_norm == nbx_norm:
-                nxb_label = nextbrain_lut[
-                    nextbrain_lut["NAME"] == nxb_orig.encode()
-                ]["ID"]
-                for nxb_label1 in nxb_label:
-                    nextbrain2allen[nxb_label1] = ont["id"]
-        for child in ont.get("children", []):
-            _recurse(child)
-
-    _recurse(allen_ont)
-
+    # (iterative preorder walk, so that when several Allen nodes share a
+    #  normalized name, the last one visited wins)
+    stack = [allen_ont]
+    while stack:
+        ont = stack.pop()
+        labels = norm2labels.get(normalize_name(ont["name"]))
+        if labels is not None:
+            nextbrain2allen[labels] = ont["id"]
+        stack.extend(reversed(ont.get("children", [])))
+
+    # use the narrowest type that holds all Allen labels, since the
+    # mapping is a memory-bound gather
+    nextbrain2allen = nextbrain2allen.astype(
+        _label_dtype(int(nextbrain2allen.max())), copy=False
+    )
+
+    nextbrain2allen.flags.writeable = False
     return nextbrain2allen
 
 
+def _label_dtype(max_label: int) -> np.dtype:
+    """Narrowest label type (uint8, uint16 or int32) that holds a label."""
+    for dtype in ("u1", "u2", "i4"):
+        if max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype("i8")
+
+
+def _cache_dir() -> str:
+    """Directory where computed label maps are stored."""
+    root = os.environ.get("XDG_CACHE_HOME") or op.expanduser("~/.cache")
+    return op.join(root, "nextbrain-utils")
+
+
 def _ensure_cortex_onto(x: str | CortexOntology) -> CortexOntology:
     return CortexOntology(getattr(CortexOntology, x, x))
 
 
+_NAME_TABLE = str.maketrans("-_", "  ", ",")
+
+
+@lru_cache(maxsize=4096)
 def normalize_name(name: str) -> str:
     """
     Normalize a name by:
@@ -219,12 +329,11 @@ def normalize_name(name: str) -> str:
         name = name[3:]
     # # Remove any standalone "left" or "right" (regardless of position).
     # name = re.sub(r'\b(left|right)\b', '', name)
-    # Remove commas.
-    name = name.replace(',', '')
-    # Replace dashes and underscores with spaces.
-    name = name.replace('-', ' ').replace('_', ' ')
+    # Remove commas, and replace dashes and underscores with spaces.
+    # (in a single pass)
+    name = name.translate(_NAME_TABLE)
     # Collapse multiple spaces.
-    name = re.sub(r'\s+', ' ', name).strip()
+    name = ' '.join(name.split())
     return name
 
 
@@ -387,3 +496,11 @@ def _fscortex_to_allen_dev() -> dict:
     convert["transversetemporal"] = "temporal neocortex"
     convert["insula"] = "insular neocortex"
     return convert
+
+
+# Cortical conversion tables, built once and shared (read-only).
+# (Desikan-Killiany labels exist in Allen as is, so they need no table)
+_CORTEX_MAPS = {
+    CortexOntology.gyral: MappingProxyType(_fscortex_to_allen_gyral()),
+    CortexOntology.developmental: MappingProxyType(_fscortex_to_allen_dev()),
+}
@@ -4,6 +4,7 @@ __author__ = "Yael Balbastre"
 # std
 import os.path as op
 from enum import StrEnum
+from functools import lru_cache, partial
 from pathlib import Path
 
 # externals
@@ -13,7 +14,8 @@ from nibabel.spatialimages import SpatialImage
 from numpy.typing import ArrayLike
 
 # internals
-from .io import load_lut, load_yaml
+from ._kernels import remap, remap_rows
+from .io import load_lut, load_yaml, map_slabs, split_nii_path
 
 LUTDIR = op.join(op.dirname(__file__), "lut")
 PATH_NEXTBRAIN = op.join(LUTDIR, "NextBrainLUT.txt")
@@ -34,7 +36,8 @@ def to_aseg(
     nextbrain: PathLike | SpatialImage | ArrayLike,
     side: str | Side | PathLike | SpatialImage | ArrayLike = Side.L,
     claustrum: bool = False,
-    save: PathLike | bool = False
+    save: PathLike | bool = False,
+    out: np.ndarray | None = None,
 ) -> SpatialImage | np.ndarray:
     """
     Convert NextBrain labels to ASeg+AParc labels.
@@ -50,6 +53,10 @@ def to_aseg(
         If False, claustrum voxels are assigned to white matter.
     save :  PathLike | bool = True
         Whether to save the converted segmentation to disk.
+    out : np.ndarray, optional
+        Preallocated output array, with the same shape as the input
+        (e.g., to reuse a buffer across subjects).
+        Its data type is that of the output labels.
 
     Returns
     -------
@@ -63,61 +70,61 @@ def to_aseg(
         nextbrain_dat = nextbrain.dataobj
     else:
         nextbrain_dat = nextbrain
-    nextbrain_dat = np.asarray(nextbrain_dat)
 
     if _is_side(side):
         side = _ensure_side(side)
     elif isinstance(side, (str, Path)):
         side = nb.load(side)
     if isinstance(side, SpatialImage):
-        side = np.asarray(side.dataobj)
+        side = side.dataobj
+    elif not isinstance(side, Side):
+        side = np.asarray(side)
 
     # prepare linear label maps
-    mapping_left = get_nextbrain2aseg_map("L", claustrum)
-    mapping_right = get_nextbrain2aseg_map("R", claustrum)
+    # (only build the hemisphere(s) that are needed)
+    if isinstance(side, Side):
+        mapping = get_nextbrain2aseg_map(side, claustrum)
+    else:
+        # (one row per side value: unassigned, left, right, so that
+        #  both hemispheres are mapped by a single gather)
+        mapping_left = get_nextbrain2aseg_map("L", claustrum)
+        mapping_right = get_nextbrain2aseg_map("R", claustrum)
+        mapping = np.stack(
+            [np.zeros_like(mapping_left), mapping_left, mapping_right]
+        )
 
     # perform mapping
+    # (labels, and sides, that are not in the map are set to zero)
     if isinstance(side, Side):
-        mapping = mapping_left if side == Side.LEFT else mapping_right
-        aseg_dat = mapping[nextbrain_dat]
+        func = partial(remap, table=mapping, keep_outside=False)
+        aseg_dat = map_slabs(func, nextbrain_dat, dtype=mapping.dtype, out=out)
     else:
-        aseg_dat = np.zeros_like(nextbrain_dat, dtype=mapping_left.dtype)
-        mask = side == 1
-        aseg_dat[mask] = mapping_left[nextbrain_dat[mask]]
-        mask = side == 2
-        aseg_dat[mask] = mapping_right[nextbrain_dat[mask]]
+        # (side slabs come first, as they select the row of the map)
+        func = partial(remap_rows, table=mapping)
+        aseg_dat = map_slabs(
+            func, side, nextbrain_dat, dtype=mapping.dtype, out=out
+        )
 
     if isinstance(nextbrain, SpatialImage):
-        header = nextbrain.header
+        header = nextbrain.header.copy()
         header.set_data_dtype(aseg_dat.dtype)
-        aseg = type(nextbrain)(aseg_dat, None, header)
+        aseg = type(nextbrain)(aseg_dat, nextbrain.affine, header)
     else:
-        aseg = nb.Nifti1Image(aseg_dat)
+        aseg = nb.Nifti1Image(aseg_dat, np.eye(4))
 
     # save
     if save:
         fname = None
         if isinstance(nextbrain, SpatialImage):
             fname = nextbrain.file_map["image"].filename
-        if isinstance(fname, str):
-            dirname = op.dirname(fname)
-            basename = op.basename(fname)
-            basename, ext = op.splitext(basename)
-            if ext in (".gz", ".bz2"):
-                compression = ext
-                basename, ext = op.splitext(basename)
-                ext += compression
-        else:
-            dirname = op.curdir
-            basename = "seg"
-            ext = ".nii.gz"
+        dirname, basename, ext = split_nii_path(fname)
         basename += ".aseg+aparc"
 
         if save is True:
             save = f"{dirname}/{basename}{ext}"
 
+        # (the in-memory image is returned, rather than reloading it)
         nb.save(aseg, save)
-        aseg = nb.load(save)
 
     # return
     if isinstance(nextbrain, SpatialImage):
@@ -130,9 +137,16 @@ def get_nextbrain2aseg_map(
     side: str | Side = "L",
     claustrum: bool = False,
 ) -> np.ndarray:
-    """Compute linear label maps."""
-    side = _ensure_side(side)
+    """
+    Compute linear label maps.
+
+    One map is built per hemisphere and reused; do not modify it in-place.
+    """
+    return _get_nextbrain2aseg_map(_ensure_side(side), bool(claustrum))
+
 
+@lru_cache(maxsize=2 * len(Side))
+def _get_nextbrain2aseg_map(side: Side, claustrum: bool) -> np.ndarray:
     # load lookup tables
     nextbrain_lut = load_lut(PATH_NEXTBRAIN)
     aseg_lut = load_lut(PATH_ASEG)
@@ -163,7 +177,8 @@ def get_nextbrain2aseg_map(
 
     if side == Side.LEFT:
         # Cortical labels: map right to left
-        nextbrain2aseg[nextbrain2aseg >= 2000] -= 1000
+        # (the map is still the identity, so labels >= 2000 are a slice)
+        nextbrain2aseg[2000:] -= 1000
 
     side_prefix = "Left-" if side == Side.LEFT else "Right-"
     for aseg_label, nextbrain_labels in aseg_map.items():
@@ -178,10 +193,13 @@ def get_nextbrain2aseg_map(
         for label in nextbrain_labels:
             nextbrain2aseg[label] = aseg_id
 
+    nextbrain2aseg.flags.writeable = False
     return nextbrain2aseg
 
 
 def _is_side(side: str | Side) -> bool:
+    if not isinstance(side, str):
+        return False
     return side.upper() in ("L", "R", "LEFT", "RIGHT")
 
 